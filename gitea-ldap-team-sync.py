@@ -3,28 +3,61 @@
 
 """gitea-ldap-team-sync.py: Sync Gitea team members with LDAP groups"""
 
+from concurrent.futures import ThreadPoolExecutor
 import json
 import ldap
+from ldap.controls import SimplePagedResultsControl
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError
 import sys
+from urllib3.util.retry import Retry
+
+# use the faster orjson parser if available
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 
 __author__  = "Lukas Brocke"
 __license__ = "MIT"
 
+# default maximum number of concurrent Gitea API requests, can be changed
+# using GITEA_WORKERS in config
+GITEA_WORKERS = 32
+# number of LDAP entries requested per page
+LDAP_PAGE_SIZE = 1000
+
+# marks a missing default value in Config.get
+_NO_DEFAULT = object()
+
 class GiteaAPI:
     """Gitea API wrapper"""
 
-    def __init__(self, host, token):
+    def __init__(self, host, token, workers = GITEA_WORKERS):
         self._host = f"{host}/api/v1"
-        self._params = {"token": token}
+        self._workers = workers
+        # reuse connections across requests instead of opening a new one
+        # (including TLS handshake) for every single API call
+        self._session = requests.Session()
+        self._session.headers["Authorization"] = f"token {token}"
+        adapter = HTTPAdapter(pool_connections = 32,
+                pool_maxsize = max(64, workers),
+                max_retries = Retry(total = 3, backoff_factor = 0.3,
+                    status_forcelist = [429, 502, 503, 504],
+                    raise_on_status = False))
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
 
     def __get(self, path):
         try:
-            r = requests.get(f"{self._host}{path}", params = self._params)
+            r = self._session.get(f"{self._host}{path}")
             if r.status_code != 200:
-                raise GiteaAPIException(f"ERR: 'GET {r.url}' returned {r.status_code}")
-            data = r.json()
+                raise GiteaAPIException(f"ERR: 'GET {r.url}' returned {r.status_code}",
+                        r.status_code)
+            data = json_loads(r.content)
+        except GiteaAPIException:
+            raise
         except HTTPError as http_e:
             raise GiteaAPIException(f"ERR: Gitea API request failed: {http_e}")
         except Exception as e:
@@ -34,18 +67,20 @@ class GiteaAPI:
 
     def __delete(self, path):
         try:
-            r = requests.delete(f"{self._host}{path}", params = self._params)
+            r = self._session.delete(f"{self._host}{path}")
         except HTTPError as http_e:
             print(f"WARN: '{r.url}' failed: {http_e}")
 
     def __put(self, path):
         try:
-            r = requests.put(f"{self._host}{path}", params = self._params)
+            r = self._session.put(f"{self._host}{path}")
         except HTTPError as http_e:
             print(f"WARN: '{r.url}' failed: {http_e}")
 
-    def get_orgs(self):
-        return self.__get("/admin/orgs")
+    def get_workers(self):
+        """Maximum number of concurrent requests"""
+
+        return self._workers
 
     def get_teams(self, org_name):
         return self.__get(f"/orgs/{org_name}/teams")
@@ -61,7 +96,10 @@ class GiteaAPI:
 
 
 class GiteaAPIException(Exception):
-    pass
+    def __init__(self, message, status_code = None):
+        super().__init__(message)
+        # HTTP status code, if a response was received
+        self.status_code = status_code
 
 
 class User:
@@ -83,28 +121,42 @@ class User:
     def get_orgs(self):
         return self._orgs
 
-    def add_ldap_group(self, group):
-        self._groups.add(group.lower())
+    def add_ldap_groups(self, groups):
+        """Expects lowercase group names"""
+
+        self._groups.update(groups)
+
+    def freeze_ldap_groups(self):
+        """LDAP groups are read-only once all users have been fetched"""
+
+        self._groups = frozenset(self._groups)
 
     def get_org(self, org_name):
-        org_name = org_name.lower()
-        if org_name not in self._orgs:
-            self._orgs[org_name] = GiteaOrganization(org_name)
+        """Returns organization by name, expects lowercase org_name"""
 
-        return self._orgs[org_name]
+        org = self._orgs.get(org_name)
+        if org is None:
+            org = self._orgs[org_name] = GiteaOrganization(org_name)
+
+        return org
 
     def is_member_of(self, org_name, team_name):
-        org_name = org_name.lower()
-        team_name = team_name.lower()
-        if org_name not in self._orgs:
+        """Expects lowercase org_name and team_name"""
+
+        org = self._orgs.get(org_name)
+        if org is None:
             return False
 
-        return team_name in self._orgs[org_name].get_teams()
+        return team_name in org.get_teams()
 
 
 class GiteaOrganization:
+    """Organization and team names are stored lowercase. To avoid lowercasing
+    the same names over and over again, they are expected to be passed in
+    lowercase already."""
+
     def __init__(self, name):
-        self._name = name.lower()
+        self._name = name
         self._teams = set()
 
     def get_name(self):
@@ -114,30 +166,89 @@ class GiteaOrganization:
         return self._teams
 
     def add_team(self, name):
-        self._teams.add(name.lower())
+        self._teams.add(name)
 
 
 class Config:
     def __init__(self, path):
-        with open(path, "r") as f:
-            self._config = json.load(f)
+        with open(path, "rb") as f:
+            self._config = json_loads(f.read())
+
+        if not isinstance(self._config, dict):
+            raise ValueError("Configuration must be a JSON object")
+
+        workers = self._config.get("GITEA_WORKERS", GITEA_WORKERS)
+        if type(workers) is not int or workers < 1:
+            raise ValueError("GITEA_WORKERS must be a positive integer")
+
+        # (org, team) -> LDAP group, for reverse lookups
+        self._team_to_group = {}
+        # LDAP group -> list of (org, team) tuples, lowercased, in MAPPING
+        # order
+        self._parsed_mapping = {}
+        # Gitea organizations that appear anywhere in the mapping, in MAPPING
+        # order (dict used as ordered set)
+        self._mapped_orgs = {}
+
+        # the mapping is validated once here instead of on every use
+        if "MAPPING" not in self._config:
+            raise ValueError("Key 'MAPPING' not found")
 
-    def get(self, key):
+        mapping = self._config["MAPPING"]
+        if not isinstance(mapping, dict):
+            raise ValueError("MAPPING must be a JSON object")
+
+        for group, teams in mapping.items():
+            if not isinstance(teams, list):
+                raise ValueError(f"Teams of LDAP group '{group}' must be a list")
+
+            # LDAP groups of users are lowercased as well
+            group = group.lower()
+            self._parsed_mapping.setdefault(group, [])
+            for team in teams:
+                if not isinstance(team, str):
+                    raise ValueError(f"Invalid Gitea team {team!r}")
+
+                split = team.lower().split("/")
+                if len(split) != 2 or not all(split):
+                    raise ValueError(f"Invalid Gitea team '{team}'")
+
+                org_name, team_name = split
+                # if a team is mapped from more than one LDAP group, the first
+                # group listed in MAPPING is the one that decides membership
+                self._team_to_group.setdefault((org_name, team_name), group)
+                self._parsed_mapping[group].append((org_name, team_name))
+                self._mapped_orgs.setdefault(org_name)
+
+    def get(self, key, default = _NO_DEFAULT):
         if key not in self._config:
+            if default is not _NO_DEFAULT:
+                return default
+
             raise KeyError(f"ERR: Key '{key}' not found in config")
 
         return self._config[key]
 
     def get_group_for(self, org_name, team_name):
-        """Check if rule for given team exists, returns LDAP group"""
+        """Check if rule for given team exists, returns LDAP group. Expects
+        lowercase org_name and team_name"""
 
-        key = f"{org_name}/{team_name}".lower()
+        return self._team_to_group.get((org_name, team_name))
 
-        for group, teams in self.get("MAPPING").items():
-            if key in map(str.lower, teams):
-                return group
+    def get_mapped_groups(self):
+        """Returns (lowercase) LDAP groups used in the mapping, in order"""
 
-        return None
+        return self._parsed_mapping.keys()
+
+    def get_mapped_orgs(self):
+        """Returns (lowercase) organizations used in the mapping, in order"""
+
+        return self._mapped_orgs.keys()
+
+    def get_teams_for(self, group):
+        """Returns list of (org, team) tuples mapped to given LDAP group"""
+
+        return self._parsed_mapping.get(group, [])
 
 
 class TeamIDMap:
@@ -146,19 +257,34 @@ class TeamIDMap:
     def __init__(self, gitea_api):
         self._api = gitea_api
         self._map = {}
+        # organizations whose teams have all been added already (or that
+        # don't exist), no need to ask the Gitea API about them again
+        self._known_orgs = set()
 
     def add(self, org_name, team_name, team_id):
-        self._map[f"{org_name}/{team_name}".lower()] = team_id
+        """Expects lowercase org_name and team_name"""
+
+        self._map[(org_name, team_name)] = team_id
+
+    def add_org(self, org_name):
+        """Marks all teams of given (lowercase) organization as added"""
+
+        self._known_orgs.add(org_name)
 
     def get_id(self, org_name, team_name):
-        org_name = org_name.lower()
-        team_name = team_name.lower()
-        key = f"{org_name}/{team_name}"
+        """Expects lowercase org_name and team_name"""
+
+        key = (org_name, team_name)
 
         if key in self._map:
             return self._map[key]
 
-        # unknown team, try to find id via Gitea API
+        if org_name in self._known_orgs:
+            return None
+
+        # unknown team (usually all teams are added while fetching Gitea
+        # users), try to find id via Gitea API, but only once per organization
+        self.add_org(org_name)
         try:
             # add all returned teams, not just the one requested
             for team in self._api.get_teams(org_name):
@@ -167,65 +293,151 @@ class TeamIDMap:
             return None
         else:
             # if team exists return id, None otherwise
-            return self._map[key] if key in self._map else None
+            return self._map.get(key)
+
 
+def ldap_connect(config):
+    """Returns a bound LDAP connection, which may be reused for searches"""
 
-def ldap_fetch_users(config, users):
     try:
         con = ldap.initialize(config.get("LDAP_HOST"))
         con.simple_bind_s(config.get("LDAP_USER"), config.get("LDAP_PASS"))
+    except ldap.LDAPError as e:
+        sys.exit(f"ERR: Connecting to LDAP failed: {e}")
+
+    return con
+
+
+def ldap_fetch_users(con, config, users):
+    try:
+        # only request the attributes actually used and fetch results in
+        # pages to stay below the server's size limit
+        page = SimplePagedResultsControl(True, size = LDAP_PAGE_SIZE, cookie = "")
+
+        while True:
+            msgid = con.search_ext(config.get("LDAP_SEARCH_BASE"),
+                    ldap.SCOPE_SUBTREE, config.get("LDAP_SEARCH_FILTER"),
+                    attrlist = ["cn", "memberUid"], serverctrls = [page])
+
+            # process entries as they arrive instead of waiting for the whole
+            # page, the final message carries the paging cookie
+            while True:
+                rtype, res, _, serverctrls = con.result3(msgid, all = 0)
+                if rtype == ldap.RES_SEARCH_RESULT:
+                    break
+                if rtype != ldap.RES_SEARCH_ENTRY:
+                    continue
 
-        res = con.search_s(config.get("LDAP_SEARCH_BASE"), ldap.SCOPE_SUBTREE,
-                config.get("LDAP_SEARCH_FILTER"))
+                for group in res:
+                    # list of group cn's, decoded once for all members
+                    cns = [cn.decode("utf-8").lower() for cn in group[1]["cn"]]
+                    # list of members uid's
+                    members = group[1]["memberUid"]
 
-        for group in res:
-            # list of group cn's
-            cns = group[1]["cn"]
-            # list of members uid's
-            members = group[1]["memberUid"]
+                    for user_name in members:
+                        user = get_user(user_name.decode("utf-8"), users)
+                        user.add_ldap_groups(cns)
 
-            for user_name in members:
-                user = get_user(user_name.decode("utf-8"), users)
-                for cn in cns:
-                    user.add_ldap_group(cn.decode("utf-8"))
+            cookies = [c.cookie for c in serverctrls
+                    if c.controlType == SimplePagedResultsControl.controlType]
+            if not cookies or not cookies[0]:
+                break
+
+            page.cookie = cookies[0]
     except ldap.LDAPError as e:
         sys.exit(f"ERR: Fetching users from LDAP failed: {e}")
 
 
-def gitea_fetch_users(api, team_id_map, users):
+def gitea_fetch_users(api, config, team_id_map, users):
+    def get_teams(org_name):
+        # organizations in the mapping might not exist (anymore), which is
+        # ignored just like unknown teams. any other error is fatal
+        try:
+            return api.get_teams(org_name)
+        except GiteaAPIException as e:
+            if e.status_code != 404:
+                raise
+
+            print(f"WARN: Organization '{org_name}' not found")
+            return []
+
     try:
         # Unfortunately, there is no fast and easy way to get all existing teams
         # and their members. Instead, the following method proved to be the
         # easiest:
-        #            GET /admin/orgs
-        #   ∀ orgs:  GET /orgs/{org}/teams
-        #   ∀ teams: GET /teams/{id}/members
-        for org in api.get_orgs():
-            org_name = org["username"]
-            
-            for team in api.get_teams(org_name):
-                team_name = team["name"]
-                team_id = team["id"]
-
-                for member in api.get_members(team_id):
+        #   ∀ mapped orgs:  GET /orgs/{org}/teams
+        #   ∀ mapped teams: GET /teams/{id}/members
+        # Teams that aren't part of the mapping are never modified, so there
+        # is no need to fetch their members (or teams of other organizations).
+        # The requests per level are independent of each other and therefore
+        # issued concurrently. Results are only merged in the main thread.
+        with ThreadPoolExecutor(max_workers = api.get_workers()) as executor:
+            org_names = list(config.get_mapped_orgs())
+
+            # names are lowercased once here instead of once per member. all
+            # teams are remembered, including those without any members, so
+            # that no further lookups are needed later on
+            teams = []
+            for org_name, org_teams in zip(org_names,
+                    executor.map(get_teams, org_names)):
+                team_id_map.add_org(org_name)
+                for team in org_teams:
+                    team_name = team["name"].lower()
+                    team_id_map.add(org_name, team_name, team["id"])
+                    if config.get_group_for(org_name, team_name) is not None:
+                        teams.append((org_name, team_name, team["id"]))
+
+            members = executor.map(api.get_members,
+                    [team_id for _, _, team_id in teams])
+
+            for (org_name, team_name, _), team_members in zip(teams,
+                    members):
+                for member in team_members:
                     user_name = member["username"]
 
                     user = get_user(user_name, users)
                     user_org = user.get_org(org_name)
                     user_org.add_team(team_name)
-                    team_id_map.add(org_name, team_name, team_id)
     except GiteaAPIException as e:
         sys.exit(f"ERR: Fetching users from Gitea failed: {e}")
 
 
+def gitea_apply_changes(api, changes):
+    """Apply collected team membership changes concurrently
+
+    Each change is a tuple (action, team_id, user_name, team), where action is
+    either "add" or "remove" and team is the "org/team" name used for output.
+    A failed change is reported and doesn't stop the others.
+    """
+
+    def apply(change):
+        action, team_id, user_name, team = change
+        try:
+            if action == "add":
+                api.add_member(team_id, user_name)
+                return f"INFO: User '{user_name}' added to {team}"
+            else:
+                api.remove_member(team_id, user_name)
+                return f"INFO: User '{user_name}' removed from {team}"
+        except requests.RequestException as e:
+            return (f"WARN: Changing membership of '{user_name}' in {team} "
+                    f"failed: {e}")
+
+    # the same team might be mapped from multiple groups of a user, don't
+    # send identical requests concurrently
+    changes = list(dict.fromkeys(changes))
+
+    with ThreadPoolExecutor(max_workers = api.get_workers()) as executor:
+        for message in executor.map(apply, changes):
+            print(message)
+
+
 def get_user(user_name, users):
-    for user in users:
-        if user.get_name() == user_name:
-            return user
+    user = users.get(user_name)
+    if user is None:
+        user = users[user_name] = User(user_name)
 
-    new_user = User(user_name)
-    users.append(new_user)
-    return new_user
+    return user
 
 
 if __name__ == "__main__":
@@ -237,53 +449,73 @@ if __name__ == "__main__":
         config = Config(path)
     except IOError:
         sys.exit(f"ERR: Cannot find config file at '{path}'")
-    except ValueError:
-        sys.exit("ERR: Configuration file is malformed")
+    except ValueError as e:
+        sys.exit(f"ERR: Configuration file is malformed: {e}")
 
-    api = GiteaAPI(config.get("GITEA_HOST"), config.get("GITEA_TOKEN"))
+    api = GiteaAPI(config.get("GITEA_HOST"), config.get("GITEA_TOKEN"),
+            config.get("GITEA_WORKERS", GITEA_WORKERS))
     team_id_map = TeamIDMap(api)
-    users = []
+    # user name -> User
+    users = {}
+
+    con = ldap_connect(config)
+    ldap_fetch_users(con, config, users)
+    try:
+        con.unbind_s()
+    except ldap.LDAPError as e:
+        # all data has been fetched already, no reason to stop here
+        print(f"WARN: Disconnecting from LDAP failed: {e}")
+
+    for user in users.values():
+        user.freeze_ldap_groups()
+
+    gitea_fetch_users(api, config, team_id_map, users)
 
-    ldap_fetch_users(config, users)
-    gitea_fetch_users(api, team_id_map, users)
+    # membership changes are collected first and applied in one batch
+    changes = []
+    # LDAP groups that are mapped to any Gitea team, with their position in
+    # MAPPING to keep changes (and output) in the same order on every run
+    mapping_order = {group: i for i, group
+            in enumerate(config.get_mapped_groups())}
+    mapping_keys = mapping_order.keys()
+    mapped_orgs = config.get_mapped_orgs()
+
+    for user in users.values():
+        user_name = user.get_name()
+        groups = user.get_groups()
+        orgs = user.get_orgs()
+
+        # nothing to do for users without any mapped groups or organizations
+        if not groups & mapping_keys and not orgs.keys() & mapped_orgs:
+            continue
 
-    for user in users:
         # step 1: search for Gitea organizations that the user is a member of
         # but shouldn't be
-        for org in user.get_orgs().values():
+        for org in orgs.values():
+            org_name = org.get_name()
             for team_name in org.get_teams():
                 # search for a rule in configuration that involves this
                 # organization and team. if none is found, let the user
                 # stay member of the team
-                group = config.get_group_for(org.get_name(), team_name)
+                group = config.get_group_for(org_name, team_name)
                 if group == None:
                     continue
 
                 # there is (at least) one rule mapping a specific LDAP group to
                 # this organization and team, however the user is not member
                 # of the LDAP group. therefore cancel his team membership
-                if group not in user.get_groups():
-                    api.remove_member(
-                        team_id_map.get_id(org.get_name(), team_name),
-                        user.get_name()
-                    )
-                    print((f"INFO: User '{user.get_name()}' removed from "
-                           f"{org.get_name()}/{team_name}"))
+                if group not in groups:
+                    changes.append((
+                        "remove",
+                        team_id_map.get_id(org_name, team_name),
+                        user_name,
+                        f"{org_name}/{team_name}"
+                    ))
 
         # step 2: add user to Gitea teams he should be member of but isn't
-        mapping = config.get("MAPPING")
-        for group, teams in mapping.items():
-            if group not in user.get_groups():
-                continue
-
-            for team in teams:
-                split = team.split("/")
-                if len(split) != 2:
-                    sys.exit(f"ERR: Invalid Gitea team '{team}'")
-
-                org_name = split[0].lower()
-                team_name = split[1].lower()
-
+        # only look at the (few) mapped groups the user is actually member of
+        for group in sorted(groups & mapping_keys, key = mapping_order.get):
+            for org_name, team_name in config.get_teams_for(group):
                 # check if user already member of team
                 if user.is_member_of(org_name, team_name):
                     continue
@@ -293,6 +525,11 @@ if __name__ == "__main__":
                 if team_id == None:
                     continue
 
-                api.add_member(team_id, user.get_name())
-                print((f"INFO: User '{user.get_name()}' added to "
-                       f"{org_name}/{team_name}"))
+                changes.append((
+                    "add",
+                    team_id,
+                    user_name,
+                    f"{org_name}/{team_name}"
+                ))
+
+    gitea_apply_changes(api, changes)